@@ -1,17 +1,17 @@
+import copy
 from functools import partial
 import os
 
-import scipy.optimize as op
 import numpy as np
-import matplotlib.pyplot as plt
-import csv
-import json
 
 from collections.abc import Callable
 
 from snac.diamond import Diamond
 from snac.cooling import linear_cool
-from snac.aggregation import aggregate_and_cool, _SCENARIOS
+from snac.aggregation import (
+    aggregate_and_cool, aggregation_residuals, _SCENARIOS, _scenario_code,
+    _SCENARIO_FUNCTIONS, _residuals, _time_steps_seconds
+    )
 
 
 class AggregationModel:
@@ -67,55 +67,163 @@ class AggregationModel:
 
         self.fitted = False
 
-    def aggregate_and_cool_partial(self, return_history: bool = False):
+        # (core age, kimberlite age, dt) and the durations they produced
+        self._durations_cache = None
+        # model inputs and the history they produced, see get_history()
+        self._history_cache = None
+
+    @property
+    def T_scenario_code(self):
+        """Integer code of T_scenario passed to the model functions, resolved
+        from the current T_scenario.
+        """
+        return _scenario_code(self.T_scenario)
+
+    def aggregate_and_cool_partial(
+            self, return_history: bool = False, return_gradient: bool = False
+            ):
         """Create a partial function of aggregate_and_cool with fixed cooling
         parameters. This can be used in optimization routines.
+
+        With return_gradient=True, the partial function returns the error and
+        its gradient, as expected by scipy.optimize.minimize with jac=True.
         """
         return partial(
             aggregate_and_cool,
             cooling_function=self.cooling_function,
-            T_scenario=self.T_scenario,
+            T_scenario=self.T_scenario_code,
             scenario_params=self.scenario_params,
-            return_history=return_history
+            return_history=return_history,
+            return_gradient=return_gradient
             )
 
-    def get_durations(self):
+    def aggregation_residuals_partial(self, return_jacobian: bool = False):
+        """Create a partial function of aggregation_residuals with fixed
+        cooling parameters. This can be used in least-squares fitting.
         """
-        Determine incremental durations for model calulations.
+        return partial(
+            aggregation_residuals,
+            cooling_function=self.cooling_function,
+            T_scenario=self.T_scenario_code,
+            scenario_params=self.scenario_params,
+            return_jacobian=return_jacobian
+            )
+
+    @property
+    def durations(self):
+        """
+        Incremental durations for model calulations.
+
+        Cached as a read-only array until the core age, kimberlite age or
+        time step change.
 
         RETURNS:
         --------
         durations | numpy.ndarray : time steps for the model
 
         """
+        key = (self.diamond.age_core, self.diamond.age_kimberlite, self.dt)
+        if self._durations_cache is not None:
+            cached_key, durations = self._durations_cache
+            if cached_key == key:
+                return durations
+
         duration_core = self.diamond.age_core - self.diamond.age_kimberlite
         durations = np.arange(0., duration_core+1, self.dt)
         durations[0] = 0.01
+        durations.flags.writeable = False
+
+        self._durations_cache = (key, durations)
 
         return durations
 
-    def run(self):
+    def get_durations(self):
+        """
+        Determine incremental durations for model calulations.
+
+        RETURNS:
+        --------
+        durations | numpy.ndarray : time steps for the model (a new,
+            writable copy on every call)
+
+        """
+        return self.durations.copy()
+
+    def run(self, global_search: bool = False, workers: int = 1):
         """
         Optimise the model history by fitting the cooling and aggregation
         parameters to the observed data.
+
+        By default, a local least-squares fit starting from the initial
+        guesses is used. With global_search=True, the whole parameter space
+        within the bounds is searched by differential evolution instead. This
+        does not depend on the initial guesses but needs many more model
+        evaluations.
+
+        PARAMS:
+        -------
+        global_search | bool : use differential evolution (default: False)
+        workers | int : number of processes for the global search; -1 uses
+            all CPU cores (default: 1)
         """
-        acp = self.aggregate_and_cool_partial()
+        import scipy.optimize as op
 
-        res = op.minimize(
-            acp,
-            x0=(self.T_start0, self.cooling_rate0),
-            bounds=(self.T_bounds, self.rate_bounds),
-            args=(
-                self.get_durations(),
-                self.diamond.age_core, self.diamond.age_rim,
-                self.diamond.c_NT, self.diamond.r_NT,
-                self.diamond.c_agg, self.diamond.r_agg),
-            tol=1e-7
+        self._history_cache = None
+
+        # bind model inputs once, so the optimiser only passes params
+        durations = self.durations
+        age_core, age_rim, _, c_NT, c_agg, r_NT, r_agg = (
+            self.diamond.as_array.tolist()
             )
 
+        if global_search:
+            # a partial of a module-level function can be sent to worker
+            # processes; 'deferred' updating keeps results independent of
+            # the number of workers
+            res = op.differential_evolution(
+                self.aggregate_and_cool_partial(),
+                bounds=(self.T_bounds, self.rate_bounds),
+                args=(durations, age_core, age_rim, c_NT, r_NT, c_agg, r_agg),
+                tol=1e-7, polish=True, seed=0,
+                workers=workers, updating='deferred'
+                )
+
+        else:
+            dt_s = _time_steps_seconds(durations)
+            cooling_function = self.cooling_function
+            T_function = _SCENARIO_FUNCTIONS[self.T_scenario_code]
+            scenario_params = self.scenario_params
+
+            def residuals(params):
+                return _residuals(
+                    params, durations, dt_s, age_core, age_rim,
+                    c_NT, r_NT, c_agg, r_agg,
+                    cooling_function, T_function, scenario_params, False
+                    )
+
+            def jacobian(params):
+                return _residuals(
+                    params, durations, dt_s, age_core, age_rim,
+                    c_NT, r_NT, c_agg, r_agg,
+                    cooling_function, T_function, scenario_params, True
+                    )
+
+            res = op.least_squares(
+                residuals,
+                x0=(self.T_start0, self.cooling_rate0),
+                jac=jacobian,
+                bounds=(
+                    (self.T_bounds[0], self.rate_bounds[0]),
+                    (self.T_bounds[1], self.rate_bounds[1])
+                    ),
+                method='trf',
+                ftol=1e-9, xtol=1e-9, gtol=1e-7, max_nfev=100
+                )
+
         self.model_results = res.x
         self.model_success = res.success
-        self.model_status = res.status
+        # differential_evolution does not report a status
+        self.model_status = res.get('status')
         self.model_message = res.message
         self.fitted = True
 
@@ -127,6 +235,10 @@ class AggregationModel:
         parameters; otherwise, use the initial guesses to project the
         aggregation and cooling history.
 
+        The history is cached, so repeated calls (e.g. for plotting and
+        saving) only run the model once for the same parameters and model
+        inputs. Each call returns new copies of the arrays.
+
         RETURNS:
         --------
         results | dict : dictionary with keys:
@@ -143,10 +255,28 @@ class AggregationModel:
         else:
             params = (self.T_start0, self.cooling_rate0)
 
+        diamond = self.diamond
+        cache_key = (
+            self.fitted, tuple(params),
+            (diamond.age_core, diamond.age_rim, diamond.age_kimberlite,
+             diamond.c_NT, diamond.c_agg, diamond.r_NT, diamond.r_agg),
+            self.dt, self.T_scenario, copy.deepcopy(self.scenario_params),
+            self.cooling_function
+            )
+        if self._history_cache is not None:
+            key, history = self._history_cache
+            try:
+                hit = key == cache_key
+            except (TypeError, ValueError):
+                # e.g. arrays in scenario_params
+                hit = False
+            if hit:
+                return _copy_history(history)
+
         acp = self.aggregate_and_cool_partial()
         NA_core, NA_rim, T_all = acp(
             params,
-            self.get_durations(),
+            self.durations,
             self.diamond.age_core,
             self.diamond.age_rim,
             self.diamond.c_NT,
@@ -168,7 +298,7 @@ class AggregationModel:
             cooling_rate = self.cooling_rate0
 
         history = {
-            'durations': self.get_durations(),
+            'durations': self.durations,
             'T_start': T_start,
             'cooling_rate': cooling_rate,
             'T_all': T_all,
@@ -178,15 +308,19 @@ class AggregationModel:
             'NB_rim': NB_rim
         }
 
-        return history
+        self._history_cache = (cache_key, history)
+
+        return _copy_history(history)
 
     def plot_T_history(self):
         """Plot the temperature history of the fitted model.
         """
+        import matplotlib.pyplot as plt
+
         T_all = self.get_history()['T_all']
         fig = plt.figure()
         ax = fig.add_subplot(1, 1, 1)
-        ax.plot(self.get_durations(), T_all, 'k-', label='T')
+        ax.plot(self.durations, T_all, 'k-', label='T')
 
         ax.set_xlabel('Time since core growth (Myr)')
         ax.set_ylabel('Temperature (deg.C)')
@@ -199,16 +333,18 @@ class AggregationModel:
         rim_start | bool : if True, plot rim data starting from rim growth
             time; if False, plot rim data from core growth time (default: True)
         """
+        import matplotlib.pyplot as plt
+
         fig = plt.figure()
         ax = fig.add_subplot(1, 1, 1)
 
         history = self.get_history()
 
         if rim_start:
-            rim_durations = [
-                d for d in history['durations']
-                if d >= self.diamond.age_core-self.diamond.age_rim
-                ]
+            rim_mask = history['durations'] >= (
+                self.diamond.age_core-self.diamond.age_rim
+                )
+            rim_durations = history['durations'][rim_mask]
             rim_start = len(history['durations'])-len(rim_durations)
             ax.plot(
                 history['durations'], history['NA_core'],
@@ -266,6 +402,8 @@ class AggregationModel:
         -------
         filename | str : path to save the .csv file
         """
+        import csv
+
         history = self.get_history()
 
         # retrieve fitted parameters for filename and remove from dictionary
@@ -279,18 +417,16 @@ class AggregationModel:
                     f"{cooling_rate*1000:.0f}K_Gyr.csv"
                     )
 
+        data = np.column_stack(list(history.values()))
+
         with open(savename, mode='w', newline='') as file:
-            writer = csv.DictWriter(
-                file,
-                fieldnames=history.keys())
+            writer = csv.writer(file)
 
             # write header
-            writer.writeheader()
+            writer.writerow(history.keys())
 
             # write data rows
-            for i in range(len(history['durations'])):
-                row = {key: history[key][i] for key in history.keys()}
-                writer.writerow(row)
+            writer.writerows(data.tolist())
 
     def to_json(self, filepath: str):
         """Save AggregationModel instance to JSON file.
@@ -299,6 +435,8 @@ class AggregationModel:
         -------
         filepath | str : path to JSON file
         """
+        import json
+
         diamond_data = {
                 'age_core': self.diamond.age_core,
                 'age_rim': self.diamond.age_rim,
@@ -348,6 +486,8 @@ class AggregationModel:
         --------
         AggregationModel instance
         """
+        import json
+
         diamond = diamond
 
         with open(filepath, 'r') as f:
@@ -410,3 +550,13 @@ class AggregationModel:
                 f"- Cooling rate: {1e3*self.model_results[1]:.2f} K/Gyr"
             )
         return msg
+
+
+def _copy_history(history):
+    """Copy a history dictionary (see AggregationModel.get_history), so that
+    callers can modify it and its arrays without affecting the cache.
+    """
+    return {
+        key: value.copy() if isinstance(value, np.ndarray) else value
+        for key, value in history.items()
+        }
@@ -0,0 +1,27 @@
+"""Numba-compiled cooling kernels.
+
+numba is optional: this module is only imported on first use by the batch
+functions in snac.cooling, which fall back to NumPy if it is not installed.
+"""
+import math
+
+from numba import guvectorize
+
+
+@guvectorize(
+    ['void(float64, float64, float64[:], float64[:])'], '(),(),(n)->(n)',
+    target='parallel', fastmath=True, cache=True
+    )
+def exp_cool_gu(T_start, rate, time, out):
+    """Exponential cooling curves, as a generalised ufunc over the time
+    axis: T_start and rate broadcast over any leading sample dimensions.
+
+    PARAMS:
+    --------
+    T_start: starting temperature of a sample (Celsius)
+    rate: exponential cooling rate of the sample (1/Myr)
+    time: elapsed times (Myr), shape (n,)
+    out: output array of shape (n,), filled with the temperatures
+    """
+    for j in range(time.shape[0]):
+        out[j] = T_start * math.exp(-rate * time[j])
@@ -1,6 +1,9 @@
 """Module for nitrogen aggregation calculations and cooling history scenarios.
 """
 
+from enum import IntEnum
+from functools import cache
+
 import numpy as np
 
 from snac.cooling import linear_cool
@@ -8,24 +11,92 @@ from snac.cooling import linear_cool
 _EAR = 81160
 _PREEXP = 293608
 
-_SCENARIOS = [
-    'continuous', 'hot_spike', 'rapid_ascent'
-    ]
+# seconds per Myr (1e6 * 365.25 * 24 * 60 * 60)
+_SEC_PER_MYR = 3.15576e13
+
+
+class _Scenario(IntEnum):
+    """Integer codes of the cooling scenarios (see aggregate_and_cool).
+    """
+    CONTINUOUS = 0
+    HOT_SPIKE = 1
+    RAPID_ASCENT = 2
+
+
+_SCENARIOS = [scenario.name.lower() for scenario in _Scenario]
+
+
+def _scenario_code(T_scenario):
+    """Resolve a cooling scenario name (e.g. 'hot_spike') or code to its
+    _Scenario code.
+    """
+    try:
+        if isinstance(T_scenario, str):
+            return _Scenario[T_scenario.upper()]
+        return _Scenario(T_scenario)
+    except (KeyError, ValueError):
+        raise ValueError(
+            f"Invalid T_scenario. Must be one of {', '.join(_SCENARIOS)}"
+            ) from None
 
 
 def aggregate(NA, T, t):
     """input: NT, NA, T and t
     returns NA_final after aggregation for time t at temperature T
-    accepts t in Myr, T in deg. C
+    accepts t in seconds, T in deg. C
     """
     rate_const = _PREEXP * np.exp(
-        -_EAR/(T+273)
+        -_EAR/(T+273.0)
         )
     NA_final = NA/(1 + rate_const * t * NA)
 
     return NA_final
 
 
+def aggregate_ufunc(NA, T, t):
+    """Broadcasting version of aggregate() for arrays of NA, T and t,
+    e.g. to evaluate many diamonds or starting temperatures at once.
+
+    If numba is installed, aggregate() is compiled into a multi-threaded
+    NumPy ufunc on first use; otherwise, an equivalent NumPy expression
+    is evaluated.
+
+    INPUT:
+    ------
+    NA | float or array: N_A concentration (ppm)
+    T | float or array: temperature (deg. C)
+    t | float or array: time (s)
+
+    RETURNS:
+    NA_final | numpy.ndarray: N_A concentration after aggregation (ppm)
+    """
+    return _aggregate_kernel()(NA, T, t)
+
+
+@cache
+def _aggregate_kernel():
+    """Build the kernel behind aggregate_ufunc (compiled once per process).
+    """
+    try:
+        from numba import vectorize
+    except ImportError:
+        return _aggregate_numpy
+
+    return vectorize(
+        ['float64(float64, float64, float64)'],
+        target='parallel', fastmath=True, cache=True
+        )(aggregate)
+
+
+def _aggregate_numpy(NA, T, t):
+    """NumPy fallback for aggregate_ufunc.
+    """
+    NA, T, t = (np.asarray(x, dtype=np.float64) for x in (NA, T, t))
+    rate_const = _PREEXP * np.exp(-_EAR/(T+273.0))
+
+    return NA/(1 + rate_const * t * NA)
+
+
 def Temp_N(t, NT, IaB):
     """
     calculate T in degrees Celsius based on nitrogen aggregation.
@@ -39,7 +110,7 @@ def Temp_N(t, NT, IaB):
     RETURNS:
     T | float: temperature (degrees Celsius)
     """
-    t *= 1e6 * 365.25 * 24 * 60 * 60  # convert Myr to seconds
+    t = t * _SEC_PER_MYR  # convert Myr to seconds
     NA = NT * (1-IaB)
     T = (-81160/(np.log(((NT/NA)-1)/(t*NT*293608))))
 
@@ -76,7 +147,8 @@ def aggregate_and_cool(params, *args, **kwargs):
     --------
     cooling_function | function: function to calculate temperature at each
         time step (default: linear_cool)
-    T_scenario | str: the cooling scenario, one of the following:
+    T_scenario | str or int: the cooling scenario (or its _Scenario code),
+        one of the following:
         'continuous' assumes continouous cooling.
             No additional parameters are required.
         'hot_spike' assumes a sharp spike in temperature at a specified time
@@ -92,6 +164,9 @@ def aggregate_and_cool(params, *args, **kwargs):
         (default: None). See T_scenario options for details.
     return_history: boolean indicating whether to return the full history of
         NA and T values (default: False)
+    return_gradient: boolean indicating whether to also return the gradient
+        of the error with respect to params (default: False). Used as jac=True
+        in scipy.optimize.minimize.
 
     RETURNS:
     --------
@@ -101,110 +176,33 @@ def aggregate_and_cool(params, *args, **kwargs):
         NA_core: list of NA values in the core at each time step
         NA_rim: list of NA values in the rim at each time step
         T_all: list of temperatures at each time step
+    OR (if return_gradient=True): tuple consisting of
+        error: as above
+        gradient: numpy.ndarray of d(error)/d(T_start) and
+            d(error)/d(cooling_rate)
     """
     # unpack parameters and arguments
     T_start, cooling_rate = params
     durations, age_core, age_rim, c_NT, r_NT, c_agg, r_agg = args
 
-    # initialize variables
-    c_NA0 = c_NT
-    c_NA1 = 0
-    r_NA0 = r_NT
-    r_NA1 = 0
-
     # unpack variadic keyword arguments
     cooling_function = kwargs.get('cooling_function', linear_cool)
-    T_scenario = kwargs.get('T_scenario', 'continuous')
+    T_function = _SCENARIO_FUNCTIONS[
+        _scenario_code(kwargs.get('T_scenario', 'continuous'))
+        ]
     scenario_params = kwargs.get('scenario_params', None)
     return_history = kwargs.get('return_history', False)
+    return_gradient = kwargs.get('return_gradient', False)
 
-    NA_core = []
-    NA_rim = []
-    T_all = []
-
-    # iterate over the cooling steps
-    i = 0
-    for duration in durations:
-        # calculate T for each duration depending on the cooling scenario
-        if T_scenario == 'continuous':
-            # simple continuous cooling
-            T = cooling_function(T_start, duration, cooling_rate)
-
-        elif T_scenario == 'hot_spike':
-            # sharp spike in temperature at specified time followed by rapid
-            # cooling until reaching continous trajectory
-            T_pulse, t_pulse_start, pulse_duration = scenario_params
-
-            # cooling before pulse
-            if duration < t_pulse_start:
-                T = cooling_function(T_start, duration, cooling_rate)
-
-            # temperature spike
-            # (linear interpolation between start and end of pulse)
-            elif (duration >= t_pulse_start) and (duration <= (
-                    t_pulse_start + pulse_duration)):
-                # interpolate linearly between T_start_pulse and T_after_pulse
-                T_start_pulse = cooling_function(
-                    T_start, t_pulse_start, cooling_rate) + T_pulse
-                T_after_pulse = cooling_function(
-                    T_start, t_pulse_start + pulse_duration, cooling_rate)
-                T = T_start_pulse + (T_after_pulse - T_start_pulse) * (
-                    (duration - t_pulse_start) / pulse_duration)
-
-            # cooling continues after pulse
-            elif duration > (t_pulse_start + pulse_duration):
-
-                T = cooling_function(T_start, duration, cooling_rate)
-
-        elif T_scenario == 'rapid_ascent':
-            # instantaneous ascent to shallower depth at specified time
-            # (i.e. drop in temperature)
-            T_drop, t_ascent = scenario_params
-
-            # before ascent starts (continuous cooling):
-            if duration < t_ascent:
-                T = cooling_function(T_start, duration, cooling_rate)
-
-            # after rapid ascent and drop in T
-            # (return to original cooling rate):
-            elif duration >= t_ascent:
-                T = cooling_function(
-                    cooling_function(T_start, t_ascent, cooling_rate) - T_drop,
-                    duration - t_ascent,
-                    cooling_rate
-                    )
-
-        else:
-            raise ValueError(
-                f"Invalid T_scenario. Must be one of {', '.join(_SCENARIOS)}"
-                )
-
-        # work out duration increment from duration list
-        if i == 0:
-            d_t = duration
-        else:
-            d_t = durations[i]-durations[i-1]
-
-        # before rim grows, only core aggregates:
-        if (age_core - duration) > age_rim:
-            c_NA1 = aggregate(c_NA0, T, d_t * 1e6 * 365.25 * 24 * 60 * 60)
-            c_NA0 = c_NA1
-
-        # after rim has grown, core and rim now both aggregate
-        elif (age_core - duration) < age_rim:
-            c_NA1 = aggregate(c_NA0, T, d_t * 1e6 * 365.25 * 24 * 60 * 60)
-            c_NA0 = c_NA1
-
-            r_NA1 = aggregate(r_NA0, T, d_t * 1e6 * 365.25 * 24 * 60 * 60)
-            r_NA0 = r_NA1
-
-        # increment i and append values to lists
-        # it may not be necessary to store all values,
-        # but might be useful for debugging/plotting
-        i += 1
-        NA_core.append(c_NA0)
-        NA_rim.append(r_NA0)
-        T_all.append(T)
+    durations = np.asarray(durations, dtype=np.float64)
+    dt_s = _time_steps_seconds(durations)
+    T_all = T_function(
+        durations, T_start, cooling_rate, cooling_function, scenario_params
+        )
+
+    NA_core, NA_rim = _run_history(
+        T_all, durations, dt_s, age_core, age_rim, float(c_NT), float(r_NT)
+        )
 
     # retrieve final aggregation values
     c_agg_model = 1-(NA_core[-1]/c_NT)
@@ -216,13 +214,344 @@ def aggregate_and_cool(params, *args, **kwargs):
         (r_agg - r_agg_model)**2 + (c_agg - c_agg_model)**2
         ) * 1e3
 
-    # convert histories to numpy arrays for efficient numeric operations
-    NA_core = np.array(NA_core)
-    NA_rim = np.array(NA_rim)
-    T_all = np.array(T_all)
-
     # optionally return the full history of NA and T values
     if return_history:
         return NA_core, NA_rim, T_all
 
+    if return_gradient:
+        dNA_core, dNA_rim = _final_NA_gradient(
+            T_all, durations, dt_s, T_start, cooling_rate, age_core, age_rim,
+            NA_core[-1], NA_rim[-1],
+            cooling_function, T_function, scenario_params
+            )
+        # d(agg_model)/dp = -d(NA)/dp / NT
+        gradient = 2e3 * (
+            (r_agg - r_agg_model) * dNA_rim / r_NT
+            + (c_agg - c_agg_model) * dNA_core / c_NT
+            )
+        return error, gradient
+
     return error
+
+
+def aggregation_residuals(params, *args, **kwargs):
+    """
+    Residuals between observed and modelled nitrogen aggregation, for use
+    with scipy.optimize.least_squares.
+
+    The sum of the squared residuals equals the error returned by
+    aggregate_and_cool.
+
+    REQUIRED INPUT:
+    --------
+    params, args: see aggregate_and_cool
+
+    OPTIONAL INPUT (BY KEYWORD):
+    --------
+    cooling_function, T_scenario, scenario_params: see aggregate_and_cool
+    return_jacobian: boolean indicating whether to return the Jacobian of
+        the residuals instead of the residuals (default: False)
+
+    RETURNS:
+    --------
+    residuals | numpy.ndarray (default): scaled differences between the
+        observed and modelled aggregation of the rim and core
+    OR (if return_jacobian=True):
+    jacobian | numpy.ndarray : 2x2 array of the derivatives of the
+        residuals (rows) with respect to T_start and cooling_rate (columns)
+    """
+    # unpack arguments
+    durations, age_core, age_rim, c_NT, r_NT, c_agg, r_agg = args
+
+    # unpack variadic keyword arguments
+    cooling_function = kwargs.get('cooling_function', linear_cool)
+    T_function = _SCENARIO_FUNCTIONS[
+        _scenario_code(kwargs.get('T_scenario', 'continuous'))
+        ]
+    scenario_params = kwargs.get('scenario_params', None)
+    return_jacobian = kwargs.get('return_jacobian', False)
+
+    durations = np.asarray(durations, dtype=np.float64)
+
+    return _residuals(
+        params, durations, _time_steps_seconds(durations),
+        age_core, age_rim, c_NT, r_NT, c_agg, r_agg,
+        cooling_function, T_function, scenario_params, return_jacobian
+        )
+
+
+def _residuals(params, durations, dt_s, age_core, age_rim,
+               c_NT, r_NT, c_agg, r_agg,
+               cooling_function, T_function, scenario_params,
+               return_jacobian, /):
+    """Positional-only core of aggregation_residuals.
+
+    Meant to be bound once per fit (see AggregationModel.run), so that
+    durations, dt_s (see _time_steps_seconds) and the scenario function
+    T_function (see _SCENARIO_FUNCTIONS) are prepared outside the
+    optimisation loop.
+    """
+    T_start, cooling_rate = params
+
+    T_all = T_function(
+        durations, T_start, cooling_rate, cooling_function, scenario_params
+        )
+
+    NA_core, NA_rim = _run_history(
+        T_all, durations, dt_s, age_core, age_rim, float(c_NT), float(r_NT)
+        )
+
+    # same scaling as the error in aggregate_and_cool
+    scale = np.sqrt(1e3)
+
+    if return_jacobian:
+        dNA_core, dNA_rim = _final_NA_gradient(
+            T_all, durations, dt_s, T_start, cooling_rate, age_core, age_rim,
+            NA_core[-1], NA_rim[-1],
+            cooling_function, T_function, scenario_params
+            )
+        # d(agg_model)/dp = -d(NA)/dp / NT
+        return scale * np.array([dNA_rim / r_NT, dNA_core / c_NT])
+
+    r_agg_model = 1-(NA_rim[-1]/r_NT)
+    c_agg_model = 1-(NA_core[-1]/c_NT)
+
+    return scale * np.array([r_agg - r_agg_model, c_agg - c_agg_model])
+
+
+def _cool(cooling_function, T_start, times, cooling_rate):
+    """Evaluate cooling_function at every time in the array times.
+
+    Cooling functions that accept arrays (such as linear_cool and
+    exponential_cool) are evaluated in one call. Functions written for
+    scalar times fail on an array (or return the wrong shape) and are
+    evaluated time step by time step instead.
+
+    RETURNS:
+    --------
+    T | numpy.ndarray : temperature at each time (deg.C)
+    """
+    try:
+        # copy, as the scenario functions modify the trajectory in place
+        T = np.array(
+            cooling_function(T_start, times, cooling_rate), dtype=np.float64
+            )
+    except (TypeError, ValueError):
+        T = None
+
+    if T is None or T.shape != times.shape:
+        T = np.fromiter(
+            (cooling_function(T_start, t, cooling_rate) for t in times),
+            dtype=np.float64, count=len(times)
+            )
+
+    return T
+
+
+def _continuous_T(durations, T_start, cooling_rate, cooling_function,
+                  scenario_params):
+    """Temperature at every time step of the 'continuous' scenario.
+
+    All scenario functions in _SCENARIO_FUNCTIONS evaluate cooling_function
+    over the whole trajectory at once (see _cool).
+
+    PARAMS:
+    --------
+    durations | numpy.ndarray : time steps for the model (Myr)
+    T_start | float : starting temperature (deg.C)
+    cooling_rate | float : cooling rate (K/Myr)
+    cooling_function | function : function to calculate temperature
+    scenario_params | tuple : parameters for the cooling scenario
+        (see aggregate_and_cool)
+
+    RETURNS:
+    --------
+    T_all | numpy.ndarray : temperature at each time step (deg.C)
+    """
+    # simple continuous cooling
+    return _cool(cooling_function, T_start, durations, cooling_rate)
+
+
+def _hot_spike_T(durations, T_start, cooling_rate, cooling_function,
+                 scenario_params):
+    """Temperature at every time step of the 'hot_spike' scenario
+    (see _continuous_T).
+    """
+    # sharp spike in temperature at specified time followed by rapid
+    # cooling until reaching continous trajectory
+    T_pulse, t_pulse_start, pulse_duration = scenario_params
+    t_pulse_end = t_pulse_start + pulse_duration
+
+    # cooling before and after pulse
+    T_all = _cool(cooling_function, T_start, durations, cooling_rate)
+
+    # temperature spike
+    # (linear interpolation between start and end of pulse)
+    during = (durations >= t_pulse_start) & (durations <= t_pulse_end)
+    T_start_pulse = cooling_function(
+        T_start, t_pulse_start, cooling_rate) + T_pulse
+    T_after_pulse = cooling_function(T_start, t_pulse_end, cooling_rate)
+    T_all[during] = np.interp(
+        durations[during],
+        (t_pulse_start, t_pulse_end), (T_start_pulse, T_after_pulse)
+        )
+
+    return T_all
+
+
+def _rapid_ascent_T(durations, T_start, cooling_rate, cooling_function,
+                    scenario_params):
+    """Temperature at every time step of the 'rapid_ascent' scenario
+    (see _continuous_T).
+    """
+    # instantaneous ascent to shallower depth at specified time
+    # (i.e. drop in temperature), then return to original cooling rate
+    T_drop, t_ascent = scenario_params
+    T_ascent = cooling_function(T_start, t_ascent, cooling_rate) - T_drop
+
+    # cooling before ascent
+    T_all = _cool(cooling_function, T_start, durations, cooling_rate)
+
+    # cooling after ascent, only evaluated from the time of ascent onwards
+    after = durations >= t_ascent
+    T_all[after] = _cool(
+        cooling_function, T_ascent, durations[after] - t_ascent, cooling_rate
+        )
+
+    return T_all
+
+
+# temperature trajectory function of each scenario, resolved once per call
+# of aggregate_and_cool or once per AggregationModel
+_SCENARIO_FUNCTIONS = {
+    _Scenario.CONTINUOUS: _continuous_T,
+    _Scenario.HOT_SPIKE: _hot_spike_T,
+    _Scenario.RAPID_ASCENT: _rapid_ascent_T,
+    }
+
+
+def _time_steps_seconds(durations):
+    """Length of each model time step in seconds.
+
+    The first step runs from 0 to durations[0].
+    """
+    dt_s = np.empty_like(durations)
+    dt_s[0] = durations[0]
+    dt_s[1:] = np.diff(durations)
+    dt_s *= _SEC_PER_MYR
+
+    return dt_s
+
+
+def _T_trajectory_gradient(durations, T_start, cooling_rate,
+                          cooling_function, T_function, scenario_params):
+    """Sensitivity of the temperature trajectory to the fitted parameters.
+
+    cooling_function may be any callable, so the derivatives are taken by
+    central differences of the trajectory (exact up to rounding for
+    linear_cool).
+
+    RETURNS:
+    --------
+    dT_dparams | numpy.ndarray : array of shape (2, len(durations)) holding
+        dT/d(T_start) and dT/d(cooling_rate) at each time step
+    """
+    dT_dparams = np.empty((2, len(durations)))
+    h_T = 1e-3
+    h_rate = 1e-6 * max(abs(cooling_rate), 1e-9)
+
+    for j, (dT_start, drate) in enumerate(((h_T, 0), (0, h_rate))):
+        T_plus = T_function(
+            durations, T_start + dT_start, cooling_rate + drate,
+            cooling_function, scenario_params
+            )
+        T_minus = T_function(
+            durations, T_start - dT_start, cooling_rate - drate,
+            cooling_function, scenario_params
+            )
+        dT_dparams[j] = (T_plus - T_minus) / (2 * (dT_start + drate))
+
+    return dT_dparams
+
+
+def _final_NA_gradient(T_all, durations, dt_s, T_start, cooling_rate,
+                       age_core, age_rim, c_NA, r_NA,
+                       cooling_function, T_function, scenario_params):
+    """Derivatives of the final N_A concentrations in core and rim with
+    respect to T_start and cooling_rate (see _NA_gradient).
+    """
+    dT_dparams = _T_trajectory_gradient(
+        durations, T_start, cooling_rate,
+        cooling_function, T_function, scenario_params
+        )
+    return _NA_gradient(
+        T_all, dT_dparams, durations, dt_s, age_core, age_rim, c_NA, r_NA
+        )
+
+
+def _aggregation_terms(T_all, durations, dt_s, age_core, age_rim):
+    """Per-step increments of 1/N_A.
+
+    Each aggregation step NA/(1 + k*t*NA) adds k*t to 1/NA, so the N_A
+    history follows from a cumulative sum of k*t over the time steps.
+
+    RETURNS:
+    --------
+    kt | numpy.ndarray : k*t at each time step
+    rim_mask | numpy.ndarray : True for time steps after the rim has grown
+    """
+    kt = _PREEXP * np.exp(-_EAR/(T_all+273.0)) * dt_s
+
+    # the core aggregates throughout, the rim only once it has grown
+    rim_mask = (age_core - durations) < age_rim
+
+    return kt, rim_mask
+
+
+def _NA_gradient(T_all, dT_dparams, durations, dt_s, age_core, age_rim,
+                 c_NA, r_NA):
+    """Derivatives of the final N_A concentrations with respect to the
+    fitted parameters.
+
+    The final 1/NA is the initial value plus the sum of k*t over all steps
+    (see _aggregation_terms). Hence d(NA)/dp = -NA**2 * sum(dk/dT * dT/dp * t).
+
+    PARAMS:
+    --------
+    T_all | numpy.ndarray : temperature at each time step (deg.C)
+    dT_dparams | numpy.ndarray : see _T_trajectory_gradient
+    durations | numpy.ndarray : time steps for the model (Myr)
+    dt_s | numpy.ndarray : length of each time step (s)
+    age_core, age_rim | int : ages of the core and rim (Ma)
+    c_NA, r_NA | float : final N_A concentrations in core and rim (ppm)
+
+    RETURNS:
+    --------
+    dNA_core, dNA_rim | numpy.ndarray : derivatives of final N_A
+        concentrations with respect to T_start and cooling_rate
+    """
+    kt, rim_mask = _aggregation_terms(
+        T_all, durations, dt_s, age_core, age_rim)
+    dkt_dT = kt * _EAR/(T_all+273.0)**2
+
+    dNA_core = -c_NA**2 * (dT_dparams @ dkt_dT)
+    dNA_rim = -r_NA**2 * (dT_dparams[:, rim_mask] @ dkt_dT[rim_mask])
+
+    return dNA_core, dNA_rim
+
+
+def _run_history(T_all, durations, dt_s, age_core, age_rim, c_NT, r_NT):
+    """Aggregation history over a precomputed temperature trajectory
+    (see aggregate_and_cool and _aggregation_terms).
+
+    RETURNS:
+    --------
+    NA_core, NA_rim | numpy.ndarray : N_A concentrations at each time step
+    """
+    kt, rim_mask = _aggregation_terms(
+        T_all, durations, dt_s, age_core, age_rim)
+
+    NA_core = 1/(1/c_NT + np.cumsum(kt))
+    NA_rim = 1/(1/r_NT + np.cumsum(np.where(rim_mask, kt, 0.)))
+
+    return NA_core, NA_rim
@@ -1,9 +1,11 @@
 """Module providing cooling functions.
 """
+import math
+
 import numpy as np
 
 
-def linear_cool(T_start, time, rate):
+def linear_cool(T_start, time, rate, out=None):
     """
     Calculate the temperature after a given time of linear cooling.
 
@@ -12,15 +14,24 @@ def linear_cool(T_start, time, rate):
     T_start: starting temperature (Celsius)
     time: elapsed time (Myr)
     rate: exponential cooling rate (1/Myr)
+    out: optional float array to write the result to, avoiding the
+        temporary arrays of the default evaluation. It may be 'time'
+        itself, but must not share memory with 'T_start'.
 
     RETURNS:
     --------
     T: temperature (Celsius) after 'time' Myr
     """
-    return T_start - time * rate
+    if out is None:
+        return T_start - time * rate
+
+    np.multiply(time, rate, out=out)
+    np.subtract(T_start, out, out=out)
+
+    return out
 
 
-def exponential_cool(T_start, time, rate):
+def exponential_cool(T_start, time, rate, out=None):
     """
     Calculate the temperature after a given time of exponential cooling.
 
@@ -29,8 +40,113 @@ def exponential_cool(T_start, time, rate):
         T_start: starting temperature (Celsius)
         time: elapsed time (Myr)
         rate: exponential cooling rate (1/Myr)
+        out: optional float array to write the result to, avoiding the
+            temporary arrays of the default evaluation. It may be 'time'
+            itself, but must not share memory with 'T_start'.
 
     RETURNS:
         T: temperature (Celsius) after 'time' Myr
     """
-    return T_start * np.exp(-rate * time)
+    if out is None:
+        # math.exp avoids NumPy's ufunc overhead on plain numbers
+        if (isinstance(T_start, (int, float))
+                and isinstance(time, (int, float))
+                and isinstance(rate, (int, float))):
+            return T_start * math.exp(-rate * time)
+
+        return T_start * np.exp(-rate * time)
+
+    # evaluate in place to avoid a temporary array per operation
+    np.multiply(rate, time, out=out)
+    np.negative(out, out=out)
+    np.exp(out, out=out)
+    np.multiply(T_start, out, out=out)
+
+    return out
+
+
+def exponential_cool_inplace(T, time, rate):
+    """
+    Apply exponential cooling over a given time to an array of
+    temperatures, overwriting it (e.g. to advance a temperature state by
+    one time step without allocating a new array).
+
+    PARAMS:
+    --------
+        T: float array of temperatures (Celsius), updated in place
+        time: elapsed time (Myr)
+        rate: exponential cooling rate (1/Myr)
+
+    RETURNS:
+        T: the input array, now holding the temperatures after 'time' Myr
+    """
+    if np.ndim(time) == 0 and np.ndim(rate) == 0:
+        # one decay factor for all elements
+        T *= math.exp(-rate * time)
+        return T
+
+    factor = np.multiply(rate, time)
+    np.negative(factor, out=factor)
+    np.exp(factor, out=factor)
+    T *= factor
+
+    return T
+
+
+def make_exponential_cool(rate):
+    """
+    Build an exponential cooling function for a fixed cooling rate, for use
+    in loops over scalar times (e.g. along one diamond's cooling path). The
+    returned function skips the input checks of exponential_cool.
+
+    PARAMS:
+    --------
+        rate: exponential cooling rate (1/Myr)
+
+    RETURNS:
+        cool: function cool(T_start, time) returning the temperature
+            (Celsius) after 'time' Myr, for scalar T_start and time
+    """
+    neg_rate = -rate
+    exp = math.exp
+
+    def cool(T_start, time):
+        return T_start * exp(neg_rate * time)
+
+    return cool
+
+
+def exponential_cool_batch(T_start, time, rate):
+    """
+    Calculate exponential cooling curves for many samples at once, e.g. for
+    Monte-Carlo or parameter-sweep studies.
+
+    If numba is installed, the curves are evaluated by a compiled,
+    multi-threaded generalised ufunc; otherwise, NumPy broadcasting is used.
+
+    PARAMS:
+    --------
+        T_start: starting temperatures (Celsius), one per sample
+        time: elapsed times (Myr), a 1-D array shared by all samples
+        rate: exponential cooling rates (1/Myr), one per sample. T_start
+            and rate may have any shapes that broadcast together, e.g.
+            (N_T, 1) and (N_rate,) for a grid of both.
+
+    RETURNS:
+        T: array of temperatures (Celsius) of shape (*samples, times)
+    """
+    T_start = np.atleast_1d(np.asarray(T_start, dtype=np.float64))
+    rate = np.atleast_1d(np.asarray(rate, dtype=np.float64))
+    time = np.ascontiguousarray(np.atleast_1d(time), dtype=np.float64)
+
+    try:
+        from snac._cooling_numba import exp_cool_gu
+    except ImportError:
+        out = np.empty(
+            np.broadcast_shapes(T_start.shape, rate.shape) + time.shape
+            )
+        return exponential_cool(
+            T_start[..., None], time, rate[..., None], out=out
+            )
+
+    return exp_cool_gu(T_start, rate, time)
@@ -1,40 +1,59 @@
 import json
+import math
+from dataclasses import dataclass
+from functools import cache
 
+import numpy as np
 
+_JSON_TEMPLATE = (
+    '{{\n'
+    '    "age_core": {age_core},\n'
+    '    "age_rim": {age_rim},\n'
+    '    "age_kimberlite": {age_kimberlite},\n'
+    '    "c_NT": {c_NT},\n'
+    '    "c_agg": {c_agg},\n'
+    '    "r_NT": {r_NT},\n'
+    '    "r_agg": {r_agg}\n'
+    '}}'
+)
+
+
+@dataclass(slots=True, frozen=True)
 class Diamond:
     """Class to store measured nitrogen aggregation information.
 
     The diamond is assumed to have two zones (core and rim), grown at different
     times in the diamond's growth history with distinct nitrogen
-    concentrations and aggregation states.
+    concentrations and aggregation states. Instances are immutable and
+    hashable.
+
+    PARAMS:
+    --------
+    age_core | int: age of the core (Ma)
+    age_rim | int: age of the rim (Ma)
+    age_kimberlite | int: eruption age of the kimberlilte (Ma)
+    c_NT | int: total nitrogen concentration in the core (ppm)
+    c_agg | float: aggregation state of the core (proportion of N in B)
+    r_NT | int: total nitrogen concentration in the rim (ppm)
+    r_agg | float: aggregation state of the rim (proportion of N in B)
     """
-    def __init__(self,
-                 age_core: int = 3520,
-                 age_rim: int = 1860,
-                 age_kimberlite: int = 0,
-                 c_NT: int = 625, c_agg: float = 0.863,
-                 r_NT: int = 801, r_agg: float = 0.197
-                 ):
-        """Initialise Diamond object.
+    age_core: int = 3520
+    age_rim: int = 1860
+    age_kimberlite: int = 0
+    c_NT: int = 625
+    c_agg: float = 0.863
+    r_NT: int = 801
+    r_agg: float = 0.197
 
-        PARAMS:
-        --------
-        age_core | int: age of the core (Ma)
-        age_rim | int: age of the rim (Ma)
-        age_kimberlite | int: eruption age of the kimberlilte (Ma)
-        c_NT | int: total nitrogen concentration in the core (ppm)
-        c_agg | float: aggregation state of the core (proportion of N in B)
-        r_NT | int: total nitrogen concentration in the rim (ppm)
-        r_agg | float: aggregation state of the rim (proportion of N in B)
+    @property
+    def as_array(self):
+        """Measured parameters packed into one float array, in the order
+        age_core, age_rim, age_kimberlite, c_NT, c_agg, r_NT, r_agg.
         """
-
-        self.age_core = age_core
-        self.age_rim = age_rim
-        self.age_kimberlite = age_kimberlite
-        self.c_NT = c_NT
-        self.c_agg = c_agg
-        self.r_NT = r_NT
-        self.r_agg = r_agg
+        return np.array([
+            self.age_core, self.age_rim, self.age_kimberlite,
+            self.c_NT, self.c_agg, self.r_NT, self.r_agg
+            ], dtype=np.float64)
 
     @classmethod
     def from_json(cls, filepath: str):
@@ -48,9 +67,58 @@ class Diamond:
         --------
         Diamond instance
         """
-        with open(filepath, 'r') as f:
-            data = json.load(f)
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+
+        return cls._from_dict(_json_loads()(raw))
+
+    @classmethod
+    def from_json_many(cls, filepaths, max_workers: None | int = None):
+        """Create Diamond instances from many JSON files, one per diamond.
+
+        The files are read in a thread pool, so that waiting on slow or
+        networked storage overlaps with parsing. For files that are already
+        cached in memory, a plain loop over from_json is faster.
+
+        PARAMS:
+        -------
+        filepaths | iterable of str : paths to JSON files
+        max_workers | None or int : number of threads (None uses the
+            default of concurrent.futures.ThreadPoolExecutor)
+
+        RETURNS:
+        --------
+        list of Diamond instances, in the order of filepaths
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(cls.from_json, filepaths))
 
+    @classmethod
+    def from_jsonl(cls, filepath: str):
+        """Create Diamond instances from a JSON Lines file, i.e. one JSON
+        object per line with the same keys as written by to_json.
+
+        PARAMS:
+        -------
+        filepath | str : path to JSON Lines file
+
+        RETURNS:
+        --------
+        list of Diamond instances
+        """
+        with open(filepath, 'rb') as f:
+            lines = f.read().splitlines()
+
+        loads = _json_loads()
+
+        return [cls._from_dict(loads(line)) for line in lines if line.strip()]
+
+    @classmethod
+    def _from_dict(cls, data):
+        """Create Diamond instance from a dict of parsed JSON data.
+        """
         return cls(
             age_core=data['age_core'],
             age_rim=data['age_rim'],
@@ -78,8 +146,16 @@ class Diamond:
             'r_agg': self.r_agg
         }
 
+        # plain finite numbers are written through a fixed template, which
+        # gives the same output as json.dump(data, f, indent=4), faster
+        if all(type(value) in (int, float) and math.isfinite(value)
+               for value in data.values()):
+            text = _JSON_TEMPLATE.format_map(data)
+        else:
+            text = json.dumps(data, indent=4)
+
         with open(filepath, 'w') as f:
-            json.dump(data, f, indent=4)
+            f.write(text)
 
     def __str__(self):
         """Return human-readable string represantation.
@@ -93,3 +169,124 @@ class Diamond:
             f"- Core: [N_T] {self.c_NT} ppm, {self.c_agg*100}%B.\n"
             f"- Rim: [N_T] {self.r_NT} ppm, {self.r_agg*100}%B."
         )
+
+
+@cache
+def _json_loads():
+    """Return the JSON parser used by Diamond.from_json and
+    Diamond.from_jsonl (msgspec if it is installed, otherwise the stdlib
+    parser). The parser is built once and reused for every file. Input
+    that msgspec rejects is parsed again by the stdlib parser, so both give
+    the same results and errors.
+    """
+    try:
+        import msgspec
+    except ImportError:
+        return json.loads
+
+    decode = msgspec.json.Decoder().decode
+
+    def loads(raw):
+        try:
+            return decode(raw)
+        except msgspec.DecodeError:
+            # e.g. NaN or Infinity, which only the stdlib parser accepts
+            return json.loads(raw)
+
+    return loads
+
+
+class DiamondArray:
+    """Class to store an ensemble of diamonds column-wise.
+
+    Every measured parameter of Diamond is held in its own 1-D array, so
+    that calculations over many diamonds can be written as vectorised NumPy
+    expressions instead of looping over Diamond instances. Ages (Ma) and
+    nitrogen concentrations (ppm) are stored as int16, which halves the
+    memory of the integer columns; they must be whole numbers up to 32767.
+    """
+    _DTYPES = {
+        'age_core': np.int16,
+        'age_rim': np.int16,
+        'age_kimberlite': np.int16,
+        'c_NT': np.int16,
+        'c_agg': np.float64,
+        'r_NT': np.int16,
+        'r_agg': np.float64
+    }
+
+    __slots__ = tuple(_DTYPES)
+
+    def __init__(self, n: int):
+        """Initialise DiamondArray with zeroed columns.
+
+        PARAMS:
+        --------
+        n | int: number of diamonds
+        """
+        for name, dtype in self._DTYPES.items():
+            setattr(self, name, np.zeros(n, dtype=dtype))
+
+    @classmethod
+    def from_diamonds(cls, diamonds):
+        """Create DiamondArray instance from a sequence of Diamonds. Raises
+        ValueError if a value does not fit the dtype of its column (e.g. a
+        non-integral or too large nitrogen concentration).
+
+        PARAMS:
+        -------
+        diamonds | sequence of Diamond : diamonds to store
+
+        RETURNS:
+        --------
+        DiamondArray instance
+        """
+        diamonds = list(diamonds)
+        array = cls(0)
+        for name, dtype in cls._DTYPES.items():
+            column = np.fromiter(
+                (getattr(diamond, name) for diamond in diamonds),
+                dtype=np.float64, count=len(diamonds)
+                )
+            # converting to an integer dtype would silently truncate
+            if np.issubdtype(dtype, np.integer):
+                info = np.iinfo(dtype)
+                valid = (
+                    (column == np.round(column))
+                    & (column >= info.min) & (column <= info.max)
+                    )
+                if not valid.all():
+                    raise ValueError(
+                        f"{name} must be whole numbers between {info.min} "
+                        f"and {info.max} to be stored as "
+                        f"{np.dtype(dtype).name}."
+                        )
+            setattr(array, name, column.astype(dtype))
+
+        return array
+
+    @classmethod
+    def from_jsons(cls, filepaths):
+        """Create DiamondArray instance from JSON files, one per diamond.
+
+        PARAMS:
+        -------
+        filepaths | iterable of str : paths to JSON files
+
+        RETURNS:
+        --------
+        DiamondArray instance
+        """
+        return cls.from_diamonds(
+            Diamond.from_json(filepath) for filepath in filepaths
+            )
+
+    def __len__(self):
+        return len(self.age_core)
+
+    def __getitem__(self, i: int):
+        """Return the i-th diamond of the ensemble as a Diamond instance.
+        """
+        return Diamond(**{
+            name: getattr(self, name)[i].item() for name in self._DTYPES
+            })
@@ -0,0 +1,116 @@
+"""Tests for snac.aggregation.
+"""
+import math
+
+import numpy as np
+import pytest
+
+from snac.aggregation import (
+    aggregate, aggregate_and_cool, aggregation_residuals
+    )
+from snac.cooling import exponential_cool
+from snac.diamond import Diamond
+from snac.SNACmodel import AggregationModel
+
+DIAMOND = Diamond()
+
+# keyword arguments of the model functions and parameters to test at
+SCENARIOS = {
+    'continuous': ({}, (1216., 0.052)),
+    'hot_spike': (
+        dict(T_scenario='hot_spike', scenario_params=(50, 1000, 25)),
+        (1210., 0.05)
+        ),
+    'rapid_ascent': (
+        dict(T_scenario='rapid_ascent', scenario_params=(20, 1000)),
+        (1213., 0.041)
+        ),
+    'exponential': (
+        dict(cooling_function=exponential_cool), (1217., 4.5e-5)
+        ),
+    }
+
+
+def _args(dt=1):
+    """Positional arguments of aggregate_and_cool for DIAMOND.
+    """
+    durations = AggregationModel(DIAMOND, dt=dt).get_durations()
+    return (
+        durations, DIAMOND.age_core, DIAMOND.age_rim,
+        DIAMOND.c_NT, DIAMOND.r_NT, DIAMOND.c_agg, DIAMOND.r_agg
+        )
+
+
+def _sqrt_cool(T_start, time, rate):
+    return T_start - rate * 50 * np.sqrt(time)
+
+
+@pytest.mark.parametrize('array_cool, scalar_cool, kwargs', [
+    (exponential_cool,
+     lambda T_start, time, rate: T_start * math.exp(-rate * time),
+     {}),
+    (_sqrt_cool,
+     lambda T_start, time, rate: T_start - rate * 50 * math.sqrt(time),
+     dict(T_scenario='rapid_ascent', scenario_params=(20, 1000))),
+    ], ids=['exponential', 'rapid_ascent'])
+def test_scalar_cooling_function(array_cool, scalar_cool, kwargs):
+    # cooling functions written for scalar times are evaluated per step
+    params = (1217., 4.5e-5)
+    args = _args()
+
+    history = aggregate_and_cool(
+        params, *args, cooling_function=scalar_cool, return_history=True,
+        **kwargs)
+    expected = aggregate_and_cool(
+        params, *args, cooling_function=array_cool, return_history=True,
+        **kwargs)
+
+    for values, expected_values in zip(history, expected):
+        np.testing.assert_allclose(values, expected_values, rtol=1e-12)
+
+
+@pytest.mark.parametrize('name', SCENARIOS)
+def test_jacobian_matches_finite_differences(name):
+    kwargs, params = SCENARIOS[name]
+    args = _args()
+
+    jacobian = aggregation_residuals(
+        params, *args, return_jacobian=True, **kwargs)
+
+    expected = np.empty((2, 2))
+    for j in range(2):
+        h = 1e-6 * params[j]
+        plus, minus = list(params), list(params)
+        plus[j] += h
+        minus[j] -= h
+        expected[:, j] = (
+            aggregation_residuals(plus, *args, **kwargs)
+            - aggregation_residuals(minus, *args, **kwargs)
+            ) / (2 * h)
+
+    np.testing.assert_allclose(jacobian, expected, rtol=1e-8)
+
+
+@pytest.mark.parametrize('dt', [1, 7])
+@pytest.mark.parametrize('name', SCENARIOS)
+def test_history_matches_recursion(name, dt):
+    kwargs, params = SCENARIOS[name]
+    args = _args(dt)
+    durations, age_core, age_rim, c_NT, r_NT, _, _ = args
+
+    NA_core, NA_rim, T_all = aggregate_and_cool(
+        params, *args, return_history=True, **kwargs)
+
+    # step-by-step aggregation; the rim only aggregates once it has grown
+    dt_s = np.diff(durations, prepend=0.) * 3.15576e13
+    expected_core, expected_rim = [], []
+    c_NA, r_NA = c_NT, r_NT
+    for T, duration, t in zip(T_all, durations, dt_s):
+        c_NA = aggregate(c_NA, T, t)
+        if age_core - duration < age_rim:
+            r_NA = aggregate(r_NA, T, t)
+        expected_core.append(c_NA)
+        expected_rim.append(r_NA)
+
+    np.testing.assert_allclose(NA_core, expected_core, rtol=1e-10)
+    np.testing.assert_allclose(NA_rim, expected_rim, rtol=1e-10)
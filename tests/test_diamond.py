@@ -0,0 +1,49 @@
+"""Tests for snac.diamond.
+"""
+import json
+
+import numpy as np
+import pytest
+
+from snac.diamond import Diamond
+
+
+def _json_dump(diamond, filepath):
+    """Reference output of to_json: json.dump with indent=4.
+    """
+    data = {name: getattr(diamond, name) for name in Diamond.__slots__}
+    with open(filepath, 'w') as f:
+        json.dump(data, f, indent=4)
+
+
+@pytest.mark.parametrize('diamond', [
+    Diamond(),
+    Diamond(age_core=3000, age_kimberlite=-1, c_NT=0,
+            c_agg=0.1 + 0.2, r_agg=5e-324),
+    Diamond(c_agg=float('nan'), r_agg=float('inf')),
+    Diamond(c_NT=True, r_NT=False),
+    Diamond(c_agg=np.float64(0.863), r_agg=np.float64('nan')),
+    ], ids=['default', 'floats', 'non-finite', 'bool', 'numpy-float64'])
+def test_to_json_matches_json_dump(tmp_path, diamond):
+    diamond.to_json(tmp_path / 'template.json')
+    _json_dump(diamond, tmp_path / 'reference.json')
+
+    output = (tmp_path / 'template.json').read_bytes()
+    assert output == (tmp_path / 'reference.json').read_bytes()
+
+    # round trip, with NaN comparing equal
+    loaded = Diamond.from_json(tmp_path / 'template.json')
+    np.testing.assert_equal(
+        [getattr(loaded, name) for name in Diamond.__slots__],
+        [getattr(diamond, name) for name in Diamond.__slots__]
+        )
+
+
+def test_to_json_rejects_numpy_integers(tmp_path):
+    # json.dump cannot serialise NumPy integers, nor can to_json
+    diamond = Diamond(c_NT=np.int64(625))
+
+    with pytest.raises(TypeError):
+        _json_dump(diamond, tmp_path / 'reference.json')
+    with pytest.raises(TypeError):
+        diamond.to_json(tmp_path / 'template.json')